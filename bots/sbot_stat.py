@@ -29,44 +29,29 @@
     ~~~~~~~~~~~
     Bot for statistics
 
-    Data format:
+    Data format (one JSON record per line, appended):
 
-        "users_log-{yyyy}-{mm}-{dd}.js"
+        "users_log-{yyyy}-{mm}-{dd}.jsonl"
 
-            {
-                "yyyy-mm-dd HH:MM": [
-                    {
-                        "U" : "user_id",
-                        "IP": "127.0.0.1"
-                    }
-                ]
-            }
+            {"t": "yyyy-mm-dd HH:MM", "users": [{"U": "user_id", "IP": ["127.0.0.1"]}]}
 
-        "stats_log-{yyyy}-{mm}-{dd}.js"
+        "stats_log-{yyyy}-{mm}-{dd}.jsonl"
 
-            {
-                "yyyy-mm-dd HH:MM": [
-                    {
-                        "S": 0,
-                        "T": 1,
-                        "C": 2
-                    }
-                ]
-            }
-
-        "speeds_log-{yyyy}-{mm}-{dd}.js"
-
-            {
-                "yyyy-mm-dd HH:MM": [
-                    {
-                        "U"            : "user_id",
-                        "provider"     : "provider_id",
-                        "station"      : "host:port",
-                        "client"       : "host:port",
-                        "response_time": 0.125
-                    }
-                ]
-            }
+            {"t": "yyyy-mm-dd HH:MM", "stats": [{"S": 0, "T": 1, "C": 2}]}
+
+        "speeds_log-{yyyy}-{mm}-{dd}.jsonl"
+
+            {"t": "yyyy-mm-dd HH:MM", "speeds": [
+                {
+                    "U"            : "user_id",
+                    "provider"     : "provider_id",
+                    "station"      : "host:port",
+                    "client"       : "host:port",
+                    "response_time": 0.125
+                }
+            ]}
+
+        records are folded back into "{tag: [...]}" by 'read_jsonl()' when queried.
 
     Fields:
         'S' - Sender type
@@ -81,18 +66,25 @@
         https://github.com/dimchat/dkd-py/blob/master/dkd/protocol/types.py
 """
 
+import asyncio
+import atexit
+import functools
+import io
+import math
+import os
+import queue
 import threading
 import time
+from sys import intern
 from typing import Optional, Union, Tuple, Set, List, Dict
 
 from dimples import DateTime
-from dimples import ID, ReliableMessage
+from dimples import ID, Document, ReliableMessage
 from dimples import ContentType, Content
 from dimples import TextContent, CustomizedContent
 from dimples import ContentProcessor, ContentProcessorCreator
 from dimples import BaseContentProcessor
 from dimples import CommonFacebook, CommonMessenger
-from dimples.database import Storage
 from dimples.client import ClientMessageProcessor
 
 from dimples.utils import Config
@@ -104,6 +96,7 @@ path = Path.dir(path=path)
 path = Path.dir(path=path)
 Path.add(path=path)
 
+from libs.utils import fast_json
 from libs.client import CustomizedContentProcessor
 from libs.client import ClientContentProcessorCreator
 
@@ -111,8 +104,35 @@ from bots.shared import GlobalVariable
 from bots.shared import create_config, start_bot
 
 
+# identifier => (document, expired time)
+_documents: Dict[ID, Tuple[Document, float]] = {}
+_DOCUMENT_EXPIRES = 300  # seconds
+_DOCUMENT_CACHE_SIZE = 1024
+
+
+async def get_document(identifier: ID, facebook: CommonFacebook) -> Optional[Document]:
+    """ get document with a short-lived cache, reports check the same users repeatedly """
+    now = time.time()
+    cached = _documents.pop(identifier, None)
+    if cached is not None and cached[1] > now:
+        doc = cached[0]
+    else:
+        doc = await facebook.get_document(identifier=identifier)
+        if doc is None:
+            # not fetched yet, it may arrive soon
+            return None
+        if len(_documents) >= _DOCUMENT_CACHE_SIZE:
+            # drop the least recently used one
+            _documents.pop(next(iter(_documents)))
+        now = time.time()
+        cached = (doc, now + _DOCUMENT_EXPIRES)
+    # move to the end
+    _documents[identifier] = cached
+    return doc
+
+
 async def get_name(identifier: ID, facebook: CommonFacebook) -> str:
-    doc = await facebook.get_document(identifier=identifier)
+    doc = await get_document(identifier=identifier, facebook=facebook)
     if doc is not None:
         name = doc.name
         if name is not None and len(name) > 0:
@@ -123,24 +143,32 @@ async def get_name(identifier: ID, facebook: CommonFacebook) -> str:
     return str(identifier.address)
 
 
-def two_digits(value: int) -> str:
-    if value < 10:
-        return '0%s' % value
-    else:
-        return '%s' % value
+def parse_time(msg_time: float) -> Tuple[str, str, str, str, str]:
+    # results only change every minute
+    return _parse_time_minute(minute_key=int(msg_time) // 60)
 
 
-def parse_time(msg_time: float) -> Tuple[str, str, str, str, str]:
-    local_time = time.localtime(msg_time)
-    assert isinstance(local_time, time.struct_time), 'time error: %s' % local_time
-    year = str(local_time.tm_year)
-    month = two_digits(value=local_time.tm_mon)
-    day = two_digits(value=local_time.tm_mday)
-    hours = two_digits(value=local_time.tm_hour)
-    minutes = two_digits(value=local_time.tm_min)
+@functools.lru_cache(maxsize=1024)
+def _parse_time_minute(minute_key: int) -> Tuple[str, str, str, str, str]:
+    local_time = time.localtime(minute_key * 60)
+    year, month, day, hours, minutes = time.strftime('%Y|%m|%d|%H|%M', local_time).split('|')
     return year, month, day, hours, minutes
 
 
+@functools.lru_cache(maxsize=1024)
+def _log_tag_minute(minute_key: int) -> str:
+    """ 'yyyy-mm-dd HH:MM' """
+    # interned, so it is shared with the tags loaded from log files
+    return intern(time.strftime('%Y-%m-%d %H:%M', time.localtime(minute_key * 60)))
+
+
+def parse_date(day: str) -> Tuple[str, str, str]:
+    """ 'yyyy-mm-dd' => ('yyyy', 'mm', 'dd'), raises ValueError """
+    # strptime rejects the dates that don't exist, such as '2024-02-31'
+    st = time.strptime(day, '%Y-%m-%d')
+    return '%04d' % st.tm_year, '%02d' % st.tm_mon, '%02d' % st.tm_mday
+
+
 def math_stat(array: List[float]) -> Tuple[str, int]:
     count = len(array)
     if count == 0:
@@ -148,14 +176,12 @@ def math_stat(array: List[float]) -> Tuple[str, int]:
     elif count == 1:
         return '%.3f' % array[0], 1
     elif count == 2:
-        right = array.pop()
-        left = array.pop(0)
-        return '%.3f, %.3f' % (left, right), count
+        return '%.3f, %.3f' % (array[0], array[1]), count
     Log.info(msg='array (%d): %s' % (count, array))
-    array = sorted(array)
-    right = array.pop()
-    left = array.pop(0)
-    mean = sum(array) / len(array)
+    # drop the min & max, without sorting
+    left = min(array)
+    right = max(array)
+    mean = (math.fsum(array) - left - right) / (count - 2)
     return '%.3f ... **%.3f** ... %.3f' % (left, mean, right), count
 
 
@@ -171,14 +197,129 @@ def parse_ip(ip):
     return array
 
 
+def merge_users(users: List) -> List[Dict]:
+    """ merge user items into '{"U": user_id, "IP": [ip, ...]}' for each user """
+    table: Dict[str, Set[str]] = {}
+    for item in users:
+        if type(item) is dict:
+            uid = item.get('U')
+            ip = item.get('IP')  # str or List[str]
+        else:
+            uid = item
+            ip = None
+        if type(uid) is not str:
+            Log.error(msg='user item error: %s' % item)
+            continue
+        ips = table.get(uid)
+        if ips is None:
+            ips = set()
+            table[uid] = ips
+        if type(ip) is str:
+            ips.add(ip)
+        elif type(ip) is list:
+            # other values can't be hashed or sorted with the strings
+            ips.update(x for x in ip if type(x) is str)
+    return [{'U': uid, 'IP': sorted(ips)} for uid, ips in table.items()]
+
+
+@functools.lru_cache(maxsize=4096)
+def _socket_address(host: str, port: int) -> str:
+    return '%s:%d' % (host, port)
+
+
+@functools.lru_cache(maxsize=4096)
+def _client_ip(address: str) -> str:
+    """ 'host:port' => 'host' """
+    return address.split(':')[0]
+
+
+@functools.lru_cache(maxsize=32)
+def _format_path(template: str, year: str, month: str, day: str) -> str:
+    return template.format_map({'yyyy': year, 'mm': month, 'dd': day})
+
+
+def read_jsonl(path: str, key: str) -> Optional[Dict[str, List]]:
+    """ fold the log records into "{tag: [...]}" """
+    if not os.path.exists(path):
+        return None
+    container: Dict[str, List] = {}
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                record = fast_json.loads(line)
+            except ValueError as e:
+                # the last line may be broken by an interrupted write
+                Log.error(msg='log record error: %s, %s' % (e, line))
+                continue
+            if type(record) is not dict:
+                Log.error(msg='log record error: %s' % line)
+                continue
+            tag = record.get('t')
+            if tag is None:
+                # "{tag: [...]}", the whole container written by older versions
+                for tag, items in record.items():
+                    _fold_items(container=container, tag=tag, items=items)
+                continue
+            _fold_items(container=container, tag=tag, items=record.get(key))
+    return container
+
+
+def _fold_items(container: Dict[str, List], tag: str, items: List):
+    if type(tag) is not str or type(items) is not list:
+        return
+    # many records share the same tag
+    tag = intern(tag)
+    array = container.get(tag)
+    if array is None:
+        array = []
+        container[tag] = array
+    array.extend(items)
+
+
+def _ends_with_newline(path: str) -> bool:
+    """ empty file or the last byte is '\\n' """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
 @Singleton
 class StatRecorder(Runner, Logging):
 
+    # flush when this many contents are waiting, or when the interval elapsed
+    FLUSH_COUNT = 256
+    FLUSH_INTERVAL = 0.5  # seconds
+    # longest sleep while nothing is coming
+    IDLE_INTERVAL = 60  # seconds
+
+    WRITE_BUFFER = 64 * 1024  # bytes
+
+    # past days' containers kept in memory, the least recently used one is dropped
+    PAST_CONTAINERS = 4
+
     def __init__(self):
         super().__init__(interval=Runner.INTERVAL_SLOW)
-        self.__lock = threading.Lock()
-        self.__contents: List[CustomizedContent] = []
+        self.__flush_lock = threading.Lock()
+        # log path => buffered writer, all opened in the same day
+        self.__writers: Dict[str, io.BufferedWriter] = {}
+        self.__writers_day: Optional[str] = None
+        # log path => "{tag: [...]}", only today's files loaded by queries
+        self.__containers: Dict[str, Dict[str, List]] = {}
+        # log path => "{tag: [...]}", a few past days, the most recently used at the end
+        self.__past_containers: Dict[str, Dict[str, List]] = {}
+        self.__contents: queue.SimpleQueue = queue.SimpleQueue()
         self.__config: Config = None
+        # option => path template
+        self.__templates: Dict[str, str] = {}
+        # module => handler
+        self.__handlers = {
+            'users': self._handle_users,
+            'stats': self._handle_stats,
+            'speeds': self._handle_speeds,
+        }
 
     @property
     def config(self) -> Optional[Config]:
@@ -188,147 +329,223 @@ class StatRecorder(Runner, Logging):
     def config(self, conf: Config):
         self.__config = conf
 
-    def _get_path(self, option: str, msg_time: float) -> str:
-        temp = self.__config.get_string(section='statistic', option=option)
-        assert temp is not None, 'failed to get users_log: %s' % self.__config
-        year, month, day, _, _ = parse_time(msg_time=msg_time)
-        return temp.replace('{yyyy}', year).replace('{mm}', month).replace('{dd}', day)
+    def _load_templates(self):
+        for option in ['users_log', 'stats_log', 'speeds_log']:
+            temp = self.__config.get_string(section='statistic', option=option)
+            assert temp is not None, 'failed to get %s: %s' % (option, self.__config)
+            # fail now if the template has other placeholders
+            _format_path(template=temp, year='yyyy', month='mm', day='dd')
+            self.__templates[option] = temp
 
-    def add_log(self, content: CustomizedContent):
-        with self.__lock:
-            self.__contents.append(content)
+    def _get_date_path(self, option: str, date: Tuple[str, str, str]) -> str:
+        """ get log path for date '(yyyy, mm, dd)' """
+        year, month, day = date
+        return _format_path(template=self.__templates[option], year=year, month=month, day=day)
 
-    def _next(self) -> Optional[CustomizedContent]:
-        with self.__lock:
-            if len(self.__contents) > 0:
-                return self.__contents.pop(0)
-
-    async def _save_users(self, msg_time: float, users: List[Dict]):
-        log_path = self._get_path(msg_time=msg_time, option='users_log')
-        container: Dict = await Storage.read_json(path=log_path)
-        if container is None:
-            container = {}
-        year, month, day, hours, minutes = parse_time(msg_time=msg_time)
-        log_tag = '%s-%s-%s %s:%s' % (year, month, day, hours, minutes)
-        array: List[Dict] = container.get(log_tag)
-        # convert List to Set
-        records: Set[Tuple[str, Optional[str]]] = set()
-        if array is not None:
-            for item in array:
-                if isinstance(item, Dict):
-                    uid = item.get('U')
-                    ips = item.get('IP')  # List[str]
-                    if isinstance(ips, List):
-                        ips = set(ips)
-                    else:
-                        assert isinstance(ips, str), 'IP error: %s' % ips
-                        tmp = set()
-                        tmp.add(ips)
-                        ips = tmp
-                else:
-                    assert isinstance(item, str), 'old user item error: %s' % item
-                    uid = item
-                    ips = set()
-                if len(ips) == 0:
-                    records.add((uid, None))
+    def add_log(self, content: CustomizedContent):
+        self.__contents.put(content)
+
+    def _drain_all(self, timeout: Optional[float] = None) -> List[CustomizedContent]:
+        """ take all waiting contents,
+            waiting until the batch is full or the timeout expired since the first one arrived
+        """
+        contents: List[CustomizedContent] = []
+        waiting = self.__contents
+        if timeout is not None:
+            try:
+                # sleep until the first content arrives
+                contents.append(waiting.get(timeout=self.IDLE_INTERVAL))
+            except queue.Empty:
+                return contents
+            expired = time.monotonic() + timeout
+            while len(contents) < self.FLUSH_COUNT:
+                remaining = expired - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    contents.append(waiting.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        # take the others already waiting, but not the ones coming after
+        for _ in range(waiting.qsize()):
+            try:
+                contents.append(waiting.get_nowait())
+            except queue.Empty:
+                break
+        return contents
+
+    def _open_log(self, log_path: str) -> io.BufferedWriter:
+        """ get cached writer for appending to the log file """
+        writer = self.__writers.get(log_path)
+        if writer is None:
+            os.makedirs(os.path.dirname(log_path), exist_ok=True)
+            fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            writer = os.fdopen(fd, 'ab', buffering=self.WRITE_BUFFER)
+            if not _ends_with_newline(path=log_path):
+                # keep the first record off the last line, e.g.: an old container
+                writer.write(b'\n')
+            self.__writers[log_path] = writer
+        return writer
+
+    def _close_log(self, log_path: str):
+        writer = self.__writers.pop(log_path, None)
+        if writer is not None:
+            try:
+                writer.close()
+            except OSError as e:
+                self.error(msg='failed to close log: %s, %s' % (e, log_path))
+
+    def _close_stale_logs(self):
+        """ close all cached files and containers when the day changed """
+        today = time.strftime('%Y-%m-%d')
+        if self.__writers_day != today:
+            for log_path in list(self.__writers.keys()):
+                self._close_log(log_path=log_path)
+            self.__containers.clear()
+            self.__past_containers.clear()
+            self.__writers_day = today
+
+    def _load_container(self, log_path: str, key: str, date: Tuple[str, str, str]) -> Dict[str, List]:
+        """ get a snapshot of the log file "{tag: [...]}",
+            the file is read only once and then kept up to date by '_write_batch()',
+            today's files are kept all day, only a few past days are kept
+        """
+        with self.__flush_lock:
+            self._close_stale_logs()
+            container = self.__containers.get(log_path)
+            if container is None:
+                past = self.__past_containers
+                container = past.pop(log_path, None)
+                if container is None:
+                    container = read_jsonl(path=log_path, key=key)
+                    if container is None:
+                        container = {}
+                if date == parse_time(msg_time=time.time())[:3]:
+                    self.__containers[log_path] = container
                 else:
-                    for ip in ips:
-                        records.add((uid, ip))
-        # add new users
-        for item in users:
-            if isinstance(item, Dict):
-                uid = item.get('U')
-                ip = item.get('IP')  # str
-            else:
-                assert isinstance(item, str), 'new user item error: %s' % item
-                uid = item
-                ip = None
-            records.add((uid, ip))
-        # convert Set to Dict
-        table: Dict[str, Set[str]] = {}
-        for item in records:
-            uid = item[0]
-            ips = table.get(uid)
-            if ips is None:
-                ips = set()
-                table[uid] = ips
-            ip = item[1]
-            if ip is not None:
-                ips.add(ip)
-        # convert Dict to List
-        array = []
-        for uid in table:
-            ips = table[uid]
-            assert isinstance(ips, Set), 'table error: %s => %s' % (uid, ips)
-            array.append({
-                'U': uid,
-                'IP': list(ips)
-            })
-        container[log_tag] = array
-        # update log file
-        return await Storage.write_json(container=container, path=log_path)
-
-    async def _save_stats(self, msg_time: float, stats: List[Dict]):
-        log_path = self._get_path(msg_time=msg_time, option='stats_log')
-        container: Dict = await Storage.read_json(path=log_path)
+                    if len(past) >= self.PAST_CONTAINERS:
+                        # drop the least recently used one
+                        past.pop(next(iter(past)))
+                    # move to the end
+                    past[log_path] = container
+            # items are never modified, copying the lists is enough
+            return {tag: list(array) for tag, array in container.items()}
+
+    async def _load_container_async(self, log_path: str, key: str,
+                                    date: Tuple[str, str, str]) -> Dict[str, List]:
+        """ load container in another thread,
+            waiting for the flush lock and reading the file must not block the event loop
+        """
+        loop = asyncio.get_running_loop()
+        task = functools.partial(self._load_container, log_path=log_path, key=key, date=date)
+        return await loop.run_in_executor(None, task)
+
+    def _update_container(self, log_path: str, bucket: Dict[str, List]):
+        """ append new items into the cached container, if it's loaded """
+        container = self.__containers.get(log_path)
         if container is None:
-            container = {}
-        year, month, day, hours, minutes = parse_time(msg_time=msg_time)
-        log_tag = '%s-%s-%s %s:%s' % (year, month, day, hours, minutes)
-        array = container.get(log_tag)
-        if array is None:
-            array = []
-            container[log_tag] = array
-        # append records
-        for item in stats:
-            array.append(item)
-        # update log file
-        return await Storage.write_json(container=container, path=log_path)
-
-    async def _save_speeds(self, msg_time: float, sender: str,
-                           provider: str, stations: List[Dict], client: Optional[str]):
-        log_path = self._get_path(msg_time=msg_time, option='speeds_log')
-        container: Dict = await Storage.read_json(path=log_path)
+            container = self.__past_containers.get(log_path)
         if container is None:
-            container = {}
-        year, month, day, hours, minutes = parse_time(msg_time=msg_time)
-        log_tag = '%s-%s-%s %s:%s' % (year, month, day, hours, minutes)
-        array = container.get(log_tag)
+            return
+        for log_tag, items in bucket.items():
+            array = container.get(log_tag)
+            if array is None:
+                array = []
+                container[log_tag] = array
+            array.extend(items)
+
+    def _append_jsonl(self, log_path: str, records: List[Dict]) -> io.BufferedWriter:
+        """ append records to the log file, one line for each """
+        writer = self._open_log(log_path=log_path)
+        for item in records:
+            writer.write(fast_json.dumps(item))
+            writer.write(b'\n')
+        return writer
+
+    # noinspection PyMethodMayBeStatic
+    def _add_items(self, batch: Dict[Tuple[str, str], Dict[str, List]],
+                   key: str, log_path: str, log_tag: str, items: List[Dict]):
+        """ buffer items into the bucket '(key, log_path) => {log_tag: [...]}' """
+        if items is None or len(items) == 0:
+            # nothing to write
+            return
+        bucket = batch.get((key, log_path))
+        if bucket is None:
+            bucket = {}
+            batch[(key, log_path)] = bucket
+        array = bucket.get(log_tag)
         if array is None:
             array = []
-            container[log_tag] = array
+            bucket[log_tag] = array
+        array.extend(items)
+
+    def _save_users(self, batch: Dict, log_date: Tuple[str, str, str], log_tag: str, users: List[Dict]):
+        log_path = self._get_date_path(option='users_log', date=log_date)
+        self._add_items(batch=batch, key='users', log_path=log_path, log_tag=log_tag, items=users)
+
+    def _save_stats(self, batch: Dict, log_date: Tuple[str, str, str], log_tag: str, stats: List[Dict]):
+        log_path = self._get_date_path(option='stats_log', date=log_date)
+        self._add_items(batch=batch, key='stats', log_path=log_path, log_tag=log_tag, items=stats)
+
+    def _save_speeds(self, batch: Dict, log_date: Tuple[str, str, str], log_tag: str, sender: str,
+                     provider: str, stations: List[Dict], client: Optional[str]):
+        log_path = self._get_date_path(option='speeds_log', date=log_date)
+        self.info(msg='station speeds: %s' % stations)
         # append speeds
-        for srv in stations:
-            host = srv.get('host')
-            port = srv.get('port')
-            response_time = srv.get('response_time')
-            socket_address = srv.get('socket_address')
-            if socket_address is not None:
-                client = socket_address
-            self.info(msg='station speed: %s' % srv)
-            item = {
-                'U': sender,
-                'provider': provider,
-                'station': '%s:%d' % (host, port),
-                'client': client,
-                'response_time': response_time,
-            }
-            array.append(item)
-        # update log file
-        return await Storage.write_json(container=container, path=log_path)
-
-    async def get_users(self, now: float) -> List[Dict]:
-        log_path = self._get_path(msg_time=now, option='users_log')
-        container = await Storage.read_json(path=log_path)
-        if container is None:
-            return []
-        users: List[Dict] = []
-        for tag in container:
-            array: List[Dict] = container.get(tag)
+        array = [{
+            'U': sender,
+            'provider': provider,
+            'station': _socket_address(host=srv['host'], port=srv['port']),
+            'client': srv.get('socket_address') or client,
+            'response_time': srv.get('response_time'),
+        } for srv in stations]
+        self._add_items(batch=batch, key='speeds', log_path=log_path, log_tag=log_tag, items=array)
+
+    def _write_batch(self, batch: Dict[Tuple[str, str], Dict[str, List]]):
+        """ write each log file once for the whole batch """
+        self._close_stale_logs()
+        written: Dict[str, io.BufferedWriter] = {}
+        for (key, log_path), bucket in batch.items():
+            try:
+                if key == 'users':
+                    # one item for each user in a minute
+                    bucket = {log_tag: merge_users(users=array) for log_tag, array in bucket.items()}
+                records = [{'t': log_tag, key: array} for log_tag, array in bucket.items() if len(array) > 0]
+                if len(records) == 0:
+                    # nothing changed, skip this file
+                    continue
+                written[log_path] = self._append_jsonl(log_path=log_path, records=records)
+            except Exception as e:
+                self.error(msg='failed to write log: %s, %s' % (e, log_path))
+                # reopen & reload it next time
+                self._close_log(log_path=log_path)
+                self.__containers.pop(log_path, None)
+                self.__past_containers.pop(log_path, None)
+                continue
+            self._update_container(log_path=log_path, bucket=bucket)
+        # flush & sync once per batch, not per record: a crash can only lose
+        # the batch being written, which is acceptable for statistics
+        for log_path, writer in written.items():
+            try:
+                writer.flush()
+                os.fsync(writer.fileno())
+            except OSError as e:
+                self.error(msg='failed to sync log: %s, %s' % (e, log_path))
+                # the items may not be on the disk, reload it next time
+                self._close_log(log_path=log_path)
+                self.__containers.pop(log_path, None)
+                self.__past_containers.pop(log_path, None)
+
+    async def get_users(self, date: Tuple[str, str, str]) -> List[Dict]:
+        log_path = self._get_date_path(option='users_log', date=date)
+        container = await self._load_container_async(log_path=log_path, key='users', date=date)
+        # user_id => result
+        users: Dict[str, Dict] = {}
+        for tag, array in container.items():
             if array is None or len(array) == 0:
                 continue
             for item in array:
-                if isinstance(item, Dict):
+                if type(item) is dict:
                     user_id = item.get('U')
                     ip_list = item.get('IP')  # List[str]
                 else:
@@ -339,36 +556,29 @@ class StatRecorder(Runner, Logging):
                     self.error('user item error: %s' % item)
                     continue
                 # seek user result
-                result: Dict = None
-                for res in users:
-                    if res.get('U') == user_id:
-                        # got it
-                        result = res
-                        break
+                result = users.get(user_id)
                 if result is None:
                     result = {
                         'U': user_id,
                         'IP': set(),
                     }
-                    users.append(result)
+                    users[user_id] = result
                 # client ip
-                if isinstance(ip_list, List):
+                if type(ip_list) is list:
                     ips: Set = result['IP']
                     for ip in ip_list:
                         ips.add(ip)
-                elif isinstance(ip_list, str):
+                elif type(ip_list) is str:
                     ips: Set = result['IP']
                     ips.add(ip_list)
-        return users
-
-    async def get_speeds(self, now: float) -> List[Dict]:
-        log_path = self._get_path(msg_time=now, option='speeds_log')
-        container = await Storage.read_json(path=log_path)
-        if container is None:
-            return []
-        speeds: List[Dict] = []
-        for tag in container:
-            array: List[Dict] = container.get(tag)
+        return list(users.values())
+
+    async def get_speeds(self, date: Tuple[str, str, str]) -> List[Dict]:
+        log_path = self._get_date_path(option='speeds_log', date=date)
+        container = await self._load_container_async(log_path=log_path, key='speeds', date=date)
+        # (station, client_ip, provider, sender) => result
+        speeds: Dict[Tuple, Dict] = {}
+        for tag, array in container.items():
             if array is None or len(array) == 0:
                 continue
             for item in array:
@@ -380,80 +590,112 @@ class StatRecorder(Runner, Logging):
                 if response_time is None or response_time <= 0:
                     self.error(msg='speed item error: %s' % item)
                     continue
-                if isinstance(client, str):
-                    client = client.split(':')[0]
-                elif isinstance(client, List):
+                if type(client) is str:
+                    client = _client_ip(address=client)
+                elif type(client) is list:
                     client = client[0]
                 # seek speed result
-                result: Dict = None
-                for res in speeds:
-                    if res.get('station') != station or res.get('client_ip') != client:
-                        continue
-                    pid = res.get('provider')
-                    if pid is not None and pid != provider:
-                        continue
-                    uid = res.get('U')
-                    if uid is not None and uid != sender:
-                        continue
-                    # got it
-                    result = res
-                    break
+                key = (station, client, provider, sender)
+                result = speeds.get(key)
                 if result is None:
                     result = {
                         'station': station,
                         'client_ip': client,
                         'rt': []
                     }
-                    speeds.append(result)
-                if sender is not None:
-                    result['U'] = sender
-                if provider is not None:
-                    result['provider'] = provider
+                    if sender is not None:
+                        result['U'] = sender
+                    if provider is not None:
+                        result['provider'] = provider
+                    speeds[key] = result
                 # response times
                 rt = result['rt']
                 rt.append(response_time)
-        return speeds
+        return list(speeds.values())
 
     def start(self):
+        self._load_templates()
+        # write the last batch when the bot exits
+        atexit.register(self.flush)
         thr = Runner.async_thread(coro=self.run())
         thr.start()
 
+    def flush(self):
+        """ write all waiting contents now """
+        self._save_contents(contents=self._drain_all())
+
     # Override
     async def process(self) -> bool:
-        content = self._next()
-        if content is None:
-            # nothing to do now, return False to have a rest
-            return False
-        now = DateTime.current_timestamp()
-        msg_time = content.time
-        msg_time = 0 if msg_time is None else msg_time.timestamp
-        if msg_time is None or msg_time < now - 3600*24*7:
-            self.warning(msg='message expired: %s' % content)
-            return True
-        try:
-            mod = content.module
-            if mod == 'users':
-                users = content.get('users')
-                await self._save_users(msg_time=msg_time, users=users)
-            elif mod == 'stats':
-                stats = content.get('stats')
-                await self._save_stats(msg_time=msg_time, stats=stats)
-            elif mod == 'speeds':
-                sender = content.get('U')
-                provider = content.get('provider')
-                stations = content.get('stations')
-                client = content.get('remote_address')
-                if isinstance(client, List):  # or isinstance(client, Tuple):
-                    assert len(client) == 2, 'socket address error: %s' % client
-                    client = '%s:%d' % (client[0], client[1])
-                await self._save_speeds(msg_time=msg_time, sender=sender,
-                                        provider=provider, stations=stations, client=client)
-            else:
-                self.warning(msg='ignore mod: %s, %s' % (mod, content))
-        except Exception as e:
-            self.error(msg='failed to process content: %s, %s' % (e, content))
+        # this thread is used by the recorder only,
+        # so it can block here until a batch is ready
+        contents = self._drain_all(timeout=self.FLUSH_INTERVAL)
+        self._save_contents(contents=contents)
+        # already waited in the queue, no more rest needed
         return True
 
+    def _save_contents(self, contents: List[CustomizedContent]):
+        if len(contents) == 0:
+            return
+        now = DateTime.current_timestamp()
+        # group contents by minute
+        minutes: Dict[int, List[CustomizedContent]] = {}
+        for content in contents:
+            msg_time = content.time
+            msg_time = 0 if msg_time is None else msg_time.timestamp
+            if msg_time is None or msg_time < now - 3600*24*7:
+                self.warning(msg='message expired: %s' % content)
+                continue
+            minute_key = int(msg_time) // 60
+            array = minutes.get(minute_key)
+            if array is None:
+                array = []
+                minutes[minute_key] = array
+            array.append(content)
+        # log date & tag are resolved once for each minute
+        batch: Dict[Tuple[str, str], Dict[str, List]] = {}
+        for minute_key, array in minutes.items():
+            year, month, day, _, _ = _parse_time_minute(minute_key=minute_key)
+            log_date = (year, month, day)
+            log_tag = _log_tag_minute(minute_key=minute_key)
+            for content in array:
+                try:
+                    self._save_content(batch=batch, content=content, log_date=log_date, log_tag=log_tag)
+                except Exception as e:
+                    self.error(msg='failed to process content: %s, %s' % (e, content))
+        with self.__flush_lock:
+            self._write_batch(batch=batch)
+
+    def _save_content(self, batch: Dict, content: CustomizedContent,
+                      log_date: Tuple[str, str, str], log_tag: str):
+        mod = content.module
+        handler = self.__handlers.get(mod)
+        if handler is None:
+            self.warning(msg='ignore mod: %s, %s' % (mod, content))
+        else:
+            handler(batch, content, log_date, log_tag)
+
+    def _handle_users(self, batch: Dict, content: CustomizedContent,
+                      log_date: Tuple[str, str, str], log_tag: str):
+        users = content['users']
+        self._save_users(batch=batch, log_date=log_date, log_tag=log_tag, users=users)
+
+    def _handle_stats(self, batch: Dict, content: CustomizedContent,
+                      log_date: Tuple[str, str, str], log_tag: str):
+        stats = content['stats']
+        self._save_stats(batch=batch, log_date=log_date, log_tag=log_tag, stats=stats)
+
+    def _handle_speeds(self, batch: Dict, content: CustomizedContent,
+                       log_date: Tuple[str, str, str], log_tag: str):
+        sender = content.get('U')
+        provider = content.get('provider')
+        stations = content['stations']
+        client = content.get('remote_address')
+        if isinstance(client, (list, tuple)):
+            host, port = client  # raises if it's not a socket address
+            client = _socket_address(host=host, port=port)
+        self._save_speeds(batch=batch, log_date=log_date, log_tag=log_tag, sender=sender,
+                          provider=provider, stations=stations, client=client)
+
 
 class TextContentProcessor(BaseContentProcessor, Logging):
     """ Process text message content """
@@ -474,7 +716,7 @@ class TextContentProcessor(BaseContentProcessor, Logging):
         identifier = ID.parse(identifier=sender)
         if identifier is None:
             return None
-        doc = await self.facebook.get_document(identifier=identifier)
+        doc = await get_document(identifier=identifier, facebook=self.facebook)
         if doc is None:
             name = None
         else:
@@ -487,7 +729,7 @@ class TextContentProcessor(BaseContentProcessor, Logging):
     async def __get_locale(self, sender: str) -> Optional[str]:
         identifier = ID.parse(identifier=sender)
         if identifier is not None:
-            doc = await self.facebook.get_document(identifier=identifier)
+            doc = await get_document(identifier=identifier, facebook=self.facebook)
             if doc is not None:
                 app = doc.get_property(name='app')
                 language = app.get('language') if isinstance(app, Dict) else None
@@ -503,18 +745,19 @@ class TextContentProcessor(BaseContentProcessor, Logging):
     async def __get_users(self, day: str) -> str:
         day = day.strip()
         if len(day) == 0:
-            now = time.time()
-            day = time.strftime('%Y-%m-%d', time.localtime(now))
+            year, month, dd, _, _ = parse_time(msg_time=time.time())
+            date = (year, month, dd)
+            day = '%s-%s-%s' % date
         else:
             try:
-                now = time.mktime(time.strptime(day, '%Y-%m-%d'))
+                date = parse_date(day=day)
             except ValueError as e:
                 text = 'error date: %s, %s' % (day, e)
                 self.error(msg=text)
                 return text
         text = '| ID | Name - Locale | IP |\n'
         text += '|---|---------------|----|\n'
-        users = await g_recorder.get_users(now=now)
+        users = await g_recorder.get_users(date=date)
         self.info(msg='users: %s' % str(users))
         for item in users:
             sender = item.get('U')
@@ -532,18 +775,19 @@ class TextContentProcessor(BaseContentProcessor, Logging):
     async def __get_speeds(self, day: str) -> str:
         day = day.strip()
         if len(day) == 0:
-            now = time.time()
-            day = time.strftime('%Y-%m-%d', time.localtime(now))
+            year, month, dd, _, _ = parse_time(msg_time=time.time())
+            date = (year, month, dd)
+            day = '%s-%s-%s' % date
         else:
             try:
-                now = time.mktime(time.strptime(day, '%Y-%m-%d'))
+                date = parse_date(day=day)
             except ValueError as e:
                 text = 'error date: %s, %s' % (day, e)
                 self.error(msg=text)
                 return text
         text = '| Name | IP | Station | Times |\n'
         text += '|-----|----|---------|-------|\n'
-        speeds = await g_recorder.get_speeds(now=now)
+        speeds = await g_recorder.get_speeds(date=date)
         self.info(msg='speeds: %s' % str(speeds))
         for item in speeds:
             sender = item.get('U')
@@ -608,6 +852,15 @@ class TextContentProcessor(BaseContentProcessor, Logging):
 class StatContentProcessor(CustomizedContentProcessor, Logging):
     """ Process customized stat content """
 
+    def __init__(self, facebook: CommonFacebook, messenger: CommonMessenger):
+        super().__init__(facebook=facebook, messenger=messenger)
+        # module => handler
+        self.__handlers = {
+            'users': self._handle_users,
+            'stats': self._handle_stats,
+            'speeds': self._handle_speeds,
+        }
+
     # Override
     async def process_content(self, content: Content, r_msg: ReliableMessage) -> List[Content]:
         assert isinstance(content, CustomizedContent), 'stat content error: %s' % content
@@ -629,29 +882,32 @@ class StatContentProcessor(CustomizedContentProcessor, Logging):
     # Override
     async def handle_action(self, act: str, sender: ID,
                             content: CustomizedContent, msg: ReliableMessage) -> List[Content]:
-        recorder = StatRecorder()
         mod = content.module
-        if mod == 'users':
-            users = content.get('users')
-            self.info(msg='received station log [%s] users: %s' % (content.time, users))
-            recorder.add_log(content=content)
-        elif mod == 'stats':
-            stats = content.get('stats')
-            self.info(msg='received station log [%s] stats: %s' % (content.time, stats))
-            recorder.add_log(content=content)
-        elif mod == 'speeds':
-            user = content.get('U')
-            provider = content.get('provider')
-            stations = content.get('stations')
-            remote = content.get('remote_address')
-            self.info(msg='received client log [%s] speeds count: %d, %s, %s => %s'
-                          % (content.time, len(stations), remote, user, provider))
-            recorder.add_log(content=content)
-        else:
+        handler = self.__handlers.get(mod)
+        if handler is None:
             self.error(msg='unknown module: %s, action: %s, [%s] %s' % (mod, act, content.time, content))
+        else:
+            handler(content)
+            StatRecorder().add_log(content=content)
         # respond nothing
         return []
 
+    def _handle_users(self, content: CustomizedContent):
+        users = content.get('users')
+        self.info(msg='received station log [%s] users: %s' % (content.time, users))
+
+    def _handle_stats(self, content: CustomizedContent):
+        stats = content.get('stats')
+        self.info(msg='received station log [%s] stats: %s' % (content.time, stats))
+
+    def _handle_speeds(self, content: CustomizedContent):
+        user = content.get('U')
+        provider = content.get('provider')
+        stations = content['stations']
+        remote = content.get('remote_address')
+        self.info(msg='received client log [%s] speeds count: %d, %s, %s => %s'
+                      % (content.time, len(stations), remote, user, provider))
+
 
 class BotContentProcessorCreator(ClientContentProcessorCreator):
 
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# ==============================================================================
+# MIT License
+#
+# Copyright (c) 2026 Albert Moky
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ==============================================================================
+
+
+"""
+    Fast JSON
+    ~~~~~~~~~
+
+    JSON coder for hot paths, backed by 'orjson' when it is installed,
+    otherwise by the standard 'json' module.
+"""
+
+import json
+import math
+from typing import Union, Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj: Any) -> bytes:
+    """ encode object to compact UTF-8 JSON bytes """
+    if orjson is not None:
+        # keys like the 'json' module: 1 => "1"
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    try:
+        text = json.dumps(obj, ensure_ascii=False, separators=(',', ':'), allow_nan=False)
+    except ValueError:
+        # 'NaN' & 'Infinity' are not JSON, write them as 'null' like orjson does
+        text = json.dumps(_finite(obj), ensure_ascii=False, separators=(',', ':'))
+    return text.encode('utf-8')
+
+
+def _finite(obj: Any) -> Any:
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    elif isinstance(obj, dict):
+        return {key: _finite(value) for key, value in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [_finite(item) for item in obj]
+    return obj
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """ decode JSON bytes (or string) """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)